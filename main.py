@@ -1,100 +1,205 @@
 # vrc_notifier: VRChatグループのインスタンスが立ったらDiscordに通知するFastAPIアプリ
 
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime
+from pathlib import Path
 from fastapi import FastAPI
-from fastapi_utils.tasks import repeat_every
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import os
-from dotenv import load_dotenv
+from pydantic_settings import BaseSettings, SettingsConfigDict
 import httpx
 import pyotp
+import websockets
 import asyncio
+import orjson
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 import random
+import time
 import colorsys
 
-load_dotenv()
-app = FastAPI()
+try:
+    import fcntl
+except ImportError:  # Windowsではファイルロックなし（単一workerで運用）
+    fcntl = None
 
-USERNAME = os.getenv("VRC_USERNAME")
-PASSWORD = os.getenv("VRC_PASSWORD")
-TOTP_SECRET = os.getenv("VRC_TOTP_SECRET")
-GROUP_ID = os.getenv("VRC_GROUP_ID")
-DISCORD_WEBHOOK_URL = os.getenv("DISCORD_WEBHOOK_URL")
+# --------------------------------------------------------
+# 設定（環境変数 / .env を起動時に1回だけ読み込んで検証）
+# --------------------------------------------------------
+class Settings(BaseSettings):
+    # .env は起動ディレクトリではなく main.py の隣を読む（env_fileの読み込みには python-dotenv が必要）
+    model_config = SettingsConfigDict(env_file=Path(__file__).parent / ".env", frozen=True, extra="ignore")
+
+    VRC_USERNAME: str
+    VRC_PASSWORD: str
+    VRC_TOTP_SECRET: str | None = None
+    VRC_GROUP_ID: str
+    DISCORD_WEBHOOK_URL: str
+    # false で監視を無効化。複数workerで起動してもリーダーロックを取れた1つだけが監視する
+    SCHEDULER_ENABLED: bool = True
+    LEADER_LOCK_PATH: str = "/tmp/vrc_notifier.leader"
+    STATE_FILE: Path = Path(__file__).parent / "state" / "seen_instance_ids.txt"  # 再起動後の再通知防止用
+    LOG_LEVEL: str = "INFO"
+
+settings = Settings()
+
+logger = logging.getLogger("vrc")
+logger.setLevel(settings.LOG_LEVEL.upper())
+logger.propagate = False
+
+# ログの書き出しはQueueListenerのスレッドで行い、イベントループを止めない
+_log_queue: queue.Queue = queue.Queue(-1)
+logger.addHandler(QueueHandler(_log_queue))
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+log_listener = QueueListener(_log_queue, _log_handler)
+
+# リクエストごとのURL生成・パースを避けるため起動時に1回だけ組み立てる
+VRC_API = "https://api.vrchat.cloud/api/1"
+INSTANCE_URL = httpx.URL(f"{VRC_API}/groups/{settings.VRC_GROUP_ID}/instances")
+AUTH_URL = httpx.URL(f"{VRC_API}/auth/user")
+TOTP_URL = httpx.URL(f"{VRC_API}/auth/twofactorauth/totp/verify")
+WEBHOOK_URL = httpx.URL(settings.DISCORD_WEBHOOK_URL)
+VRC_AUTH = (settings.VRC_USERNAME, settings.VRC_PASSWORD)
+TOTP_GEN = pyotp.TOTP(settings.VRC_TOTP_SECRET) if settings.VRC_TOTP_SECRET else None  # 秘密鍵のデコードは起動時の1回だけ
+
+seen_instance_ids: OrderedDict[str, None] = OrderedDict()  # 通知済みのインスタンスID（古い順のLRU）
+SEEN_INSTANCE_LIMIT = 64
+seen_limit = SEEN_INSTANCE_LIMIT  # 稼働中インスタンスが多いときは追い出さないよう広げる
+pending_instance_ids: set[str] = set()  # キュー投入済み・送信待ちのインスタンスID
+notify_queue: asyncio.Queue = asyncio.Queue()  # 新規インスタンスの通知待ち
+NOTIFY_DEBOUNCE_SECONDS = 0.3  # 最初の1件からこの時間内に来たものを1通にまとめる
+NOTIFY_RETRY_MIN_SECONDS = 5  # 送信失敗時の再送待ち（失敗が続くと倍々に延ばす）
+NOTIFY_RETRY_MAX_SECONDS = 300
+MAX_EMBED_FIELDS = 25  # Discord Embedのフィールド上限
+MAX_EMBED_CHARS = 6000  # Discord Embedの文字数上限（title + フィールドのname/value合計）
+app_client: httpx.AsyncClient | None = None  # VRChat・Discord共通のHTTPクライアント（lifespanで生成）
+vrc_client: httpx.AsyncClient | None = None  # ログイン済みセッション（app_clientを指す）
+pipeline_connected = False  # WebSocket接続中はポーリングを止める
+login_lock = asyncio.Lock()  # Pipelineと定期監視の同時ログイン防止
+
+JSON_HEADERS = {"Content-Type": "application/json"}
 
-last_instance_id = None
-vrc_client: httpx.AsyncClient | None = None  # セッション再利用用
+def _json(res: httpx.Response):
+    return orjson.loads(res.content)
 
 # --------------------------------------------------------
 # VRChatログインセッションの取得
 # --------------------------------------------------------
 async def login_vrchat(max_retries: int = 5) -> httpx.AsyncClient:
+    async with login_lock:
+        return await _login_vrchat(max_retries)
+
+async def _login_vrchat(max_retries: int, res: httpx.Response | None = None) -> httpx.AsyncClient:
+    # res: 呼び出し側で取得済みの /auth/user の応答（あれば1回目はそれを使う）
     global vrc_client
 
     if vrc_client:
         return vrc_client  # 再利用
 
+    client = app_client
     for attempt in range(max_retries):
-        client = httpx.AsyncClient()
-        res = await client.get(
-            "https://api.vrchat.cloud/api/1/auth/user",
-            auth=(USERNAME, PASSWORD)
-        )
+        if res is None:
+            res = await client.get(
+                AUTH_URL,
+                auth=VRC_AUTH
+            )
 
-        print("Login status code:", res.status_code)
-        print("Login response:", res.text)
+        logger.debug("Login status code: %s", res.status_code)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Login response: %s", res.text)
 
         if res.status_code == 200:
-            data = res.json()
+            data = _json(res)
             if "requiresTwoFactorAuth" in data:
-                print("🔐 TOTPが必要なアカウントです。認証開始…")
-                code = pyotp.TOTP(TOTP_SECRET).now()
+                logger.info("🔐 TOTPが必要なアカウントです。認証開始…")
+                if TOTP_GEN is None:
+                    raise Exception("❌ 2FAが必要ですが VRC_TOTP_SECRET が設定されていません")
+                code = TOTP_GEN.now()
                 verify = await client.post(
-                    "https://api.vrchat.cloud/api/1/auth/twofactorauth/totp/verify",
-                    json={"code": code}
+                    TOTP_URL,
+                    content=orjson.dumps({"code": code}), headers=JSON_HEADERS
                 )
-                print("TOTP verify status:", verify.status_code)
-                print("TOTP verify response:", verify.text)
+                logger.debug("TOTP verify status: %s", verify.status_code)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("TOTP verify response: %s", verify.text)
 
                 if verify.status_code == 200:
-                    print("✅ 2FA認証成功！")
+                    logger.info("✅ 2FA認証成功！")
                     vrc_client = client
                     return client
                 elif verify.status_code == 429:
                     wait_time = 2 ** attempt
-                    print(f"⏳ レート制限、{wait_time}秒待機して再試行 ({attempt + 1}/{max_retries})")
-                    await client.aclose()
+                    logger.warning("⏳ レート制限、%s秒待機して再試行 (%s/%s)", wait_time, attempt + 1, max_retries)
+                    client.cookies.clear()
                     await asyncio.sleep(wait_time)
+                    res = None
                     continue
             else:
-                print("✅ 2FA不要のアカウント、ログイン完了")
+                logger.info("✅ 2FA不要のアカウント、ログイン完了")
                 vrc_client = client
                 return client
 
-        await client.aclose()
+        client.cookies.clear()
         break
 
     raise Exception("❌ 2FA認証失敗またはログイン不能（リトライ上限）")
 
 # --------------------------------------------------------
-# インスタンス一覧取得（セッション失効時は再ログイン）
+# セッション更新（期限切れのauthだけ取り直す）
+# 2FA済み端末のtwoFactorAuth Cookieが残っていればTOTPなしで通る
 # --------------------------------------------------------
-async def get_group_instances():
+async def refresh_vrchat_session():
+    global vrc_client
+    async with login_lock:
+        app_client.cookies.delete("auth")
+        vrc_client = None
+        res = await app_client.get(
+            AUTH_URL,
+            auth=VRC_AUTH
+        )
+        logger.debug("Refresh status code: %s", res.status_code)
+        # 2FAを求められたら、この応答のままTOTPへ進む（/auth/userを送り直さない）
+        await _login_vrchat(5, res)
+
+async def reset_vrchat_session():
+    # twoFactorAuthも含めてCookieを捨て、次のlogin_vrchatでTOTPからやり直す
     global vrc_client
+    async with login_lock:
+        vrc_client = None
+        app_client.cookies.clear()
+
+# --------------------------------------------------------
+# インスタンス一覧取得（セッション失効時は更新→再ログイン）
+# --------------------------------------------------------
+async def get_group_instances(attempt: int = 0):
     try:
         client = await login_vrchat()
-        instance_url = f"https://api.vrchat.cloud/api/1/groups/{GROUP_ID}/instances"
-        res = await client.get(instance_url)
+        # ボディを読み切ってすぐ接続をプールに返す
+        async with client.stream("GET", INSTANCE_URL) as res:
+            body = await res.aread()
 
-        if res.status_code == 401:
-            print("⚠ セッション期限切れ。再ログイン中…")
-            vrc_client = None
-            return await get_group_instances()
+        # 401: 1回目はセッション更新、それでも401ならTOTPから再ログインして取り直す
+        if res.status_code == 401 and attempt < 2:
+            if attempt == 0:
+                logger.warning("⚠ セッション期限切れ。セッション更新中…")
+                await refresh_vrchat_session()
+            else:
+                logger.warning("⚠ 更新後も401のため、TOTPから再ログイン中…")
+                await reset_vrchat_session()
+            return await get_group_instances(attempt + 1)
 
-        print("Instance status code:", res.status_code)
-        print("Instance response:", res.text)
+        logger.debug("Instance status code: %s", res.status_code)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Instance response: %s", body.decode(errors="replace"))
 
+        data = orjson.loads(body) if "application/json" in res.headers.get("content-type", "") else {}
         if res.status_code == 200:
-            return res.json()
+            return data
         else:
-            detail = res.json().get("error", {}).get("message", "Unknown error")
+            detail = data.get("error", {}).get("message", "Unknown error") if isinstance(data, dict) else "Unknown error"
             raise Exception(f"インスタンス取得失敗: {detail}")
     except Exception as e:
         raise e
@@ -102,55 +207,345 @@ async def get_group_instances():
 # --------------------------------------------------------
 # Discord通知（Embed・パステルカラー）
 # --------------------------------------------------------
-async def notify_discord(instance):
-    if not DISCORD_WEBHOOK_URL:
-        print("❌ Webhook URLが設定されていません")
-        return
+def _pastel_color(h: float, s: float = 0.4, l: float = 0.8) -> int:
+    r, g, b = colorsys.hls_to_rgb(h, l, s)
+    return (int(r * 255) << 16) + (int(g * 255) << 8) + int(b * 255)
+
+# 色相1度刻み（360色）のパステルカラー表と、毎回変わらないEmbedの項目
+PASTEL_LUT = [_pastel_color(i / 360) for i in range(360)]
+EMBED_TEMPLATE = {
+    "title": "🎉 新しいグループインスタンスが立ったよ！",
+    "color": 0x00BFFF,
+}
+FIELD_VALUE_TMPL = (
+    "**人数:** {members}人\n"
+    "**Location:** `{loc}`\n"
+    "[VRChatで開く](https://vrchat.com/home/launch?worldId={wid}&instanceId={iid})"
+)
+
+EMBED_DEDUP_TTL = 600  # 同じ内容のEmbedはこの秒数内なら再送しない
+_last_embed_hash: int | None = None
+_last_embed_at: float = 0
 
+def _instance_field(instance) -> dict:
     world = instance.get("world", {})
-    h = random.random()
-    s = 0.4
-    l = 0.8
-    r, g, b = colorsys.hls_to_rgb(h, l, s)
-    pastel_color = (int(r * 255) << 16) + (int(g * 255) << 8) + int(b * 255)
-
-    embed = {
-        "title": "🎉 新しいグループインスタンスが立ったよ！",
-        "description": f"**ワールド名:** {world.get('name', '不明')}\n"
-                       f"**人数:** {instance.get('memberCount', '?')}人\n"
-                       f"**Location:** `{instance.get('location', '不明')}`\n"
-                       f"[VRChatで開く](https://vrchat.com/home/launch?worldId={world.get('id')}&instanceId={instance.get('instanceId')})",
-        "thumbnail": {"url": world.get("thumbnailImageUrl", "")},
-        "color": pastel_color
+    return {
+        "name": str(world.get("name", "不明")),
+        "value": FIELD_VALUE_TMPL.format_map({
+            "members": instance.get("memberCount", "?"),
+            "loc": instance.get("location", "不明"),
+            "wid": world.get("id"),
+            "iid": instance.get("instanceId"),
+        }),
     }
 
-    async with httpx.AsyncClient() as client:
-        await client.post(DISCORD_WEBHOOK_URL, json={"embeds": [embed]})
+def chunk_instances(instances) -> list[list]:
+    # フィールド数と文字数の両方がDiscordの上限に収まるように分割
+    base = len(EMBED_TEMPLATE["title"])
+    chunks: list[list] = []
+    chunk: list = []
+    size = base
+    for instance in instances:
+        field = _instance_field(instance)
+        field_size = len(field["name"]) + len(field["value"])
+        if chunk and (len(chunk) >= MAX_EMBED_FIELDS or size + field_size >= MAX_EMBED_CHARS):
+            chunks.append(chunk)
+            chunk, size = [], base
+        chunk.append(instance)
+        size += field_size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+async def notify_discord(instances, dedup: bool = True) -> bool:
+    # 戻り値: 送信したらTrue、直前と同じ内容でスキップしたらFalse
+    global _last_embed_hash, _last_embed_at
+    # インスタンスごとに1フィールド
+    fields = [_instance_field(instance) for instance in instances]
+
+    embed = EMBED_TEMPLATE.copy()
+    embed["fields"] = fields
+    embed["thumbnail"] = {"url": instances[0].get("world", {}).get("thumbnailImageUrl", "")}
+
+    # 色は毎回ランダムなので、色を付ける前の内容で比較する
+    h = hash(orjson.dumps(embed, option=orjson.OPT_SORT_KEYS))
+    now = time.monotonic()
+    if dedup and h == _last_embed_hash and now - _last_embed_at < EMBED_DEDUP_TTL:
+        logger.debug("🔁 直前と同じ内容のため通知をスキップ")
+        return False
+
+    embed["color"] = PASTEL_LUT[random.randrange(len(PASTEL_LUT))]
+
+    res = await app_client.post(WEBHOOK_URL, content=orjson.dumps({"embeds": [embed]}), headers=JSON_HEADERS)
+    res.raise_for_status()  # 429などは呼び出し側で失敗として扱う
+    _last_embed_hash, _last_embed_at = h, now
+    return True
 
 # --------------------------------------------------------
-# 起動時の定期監視処理（60秒おき）
+# 通知済みインスタンスIDの保存・読み込み
 # --------------------------------------------------------
-@app.on_event("startup")
-@repeat_every(seconds=60)
-async def startup_event():
-    global last_instance_id
+def load_seen_instance_ids():
+    if settings.STATE_FILE.exists():
+        # 保存時点で上限内なので切り詰めない（稼働中のIDを落とさない）
+        for instance_id in settings.STATE_FILE.read_text().split():
+            seen_instance_ids[instance_id] = None
+
+def _write_state(ids: list[str]):
+    # 一時ファイルに書いてから置き換え、途中で落ちても空のファイルを残さない
+    path = settings.STATE_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text("\n".join(ids))
+    os.replace(tmp, path)
+
+async def save_seen_instance_ids():
+    await asyncio.to_thread(_write_state, list(seen_instance_ids))
+
+# --------------------------------------------------------
+# 通知キューの消費（短時間に来た新規インスタンスを1通にまとめる）
+# --------------------------------------------------------
+async def notify_worker():
+    loop = asyncio.get_running_loop()
+    # 再送待ち（Pipeline接続中は定期監視が止まるので、ここで送り直す）
+    retry: list = []
+    retry_at = 0.0
+    retry_delay = NOTIFY_RETRY_MIN_SECONDS
+    while True:
+        batch = []
+        try:
+            timeout = max(0.0, retry_at - loop.time()) if retry else None
+            batch.append(await asyncio.wait_for(notify_queue.get(), timeout=timeout))
+        except asyncio.TimeoutError:
+            pass
+
+        if batch:
+            deadline = loop.time() + NOTIFY_DEBOUNCE_SECONDS
+            while True:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(notify_queue.get(), timeout=timeout))
+                except asyncio.TimeoutError:
+                    break
+
+        if retry and loop.time() >= retry_at:
+            batch = retry + batch
+            retry = []
+        if not batch:
+            continue
+
+        # Embedの上限ごとに分けて、共有クライアント上で並行送信
+        chunks = chunk_instances(batch)
+        results = await asyncio.gather(*(notify_discord(c) for c in chunks), return_exceptions=True)
+        done = False
+        wait = 0.0
+        for chunk, result in zip(chunks, results):
+            ids = [i["instanceId"] for i in chunk]
+            if isinstance(result, Exception):
+                if _is_retryable(result):
+                    # pendingのまま再送待ちに回す（重複してキューに入らない）
+                    retry.extend(chunk)
+                    wait = max(wait, retry_delay, _retry_after(result))
+                    logger.error("❌ Discord通知中にエラー発生（%s件を再送予定）: %s", len(chunk), result)
+                    continue
+                # 400など送り直しても通らないものは、再送し続けないよう通知済み扱いにする
+                logger.error("❌ Discord通知に失敗（再送しません）: %s", result)
+            elif result:
+                logger.info("✅ Discordに通知を送信しました（%s件）", len(chunk))
+            else:
+                logger.info("🔁 直前と同じ内容のため送信をスキップしました（%s件）", len(chunk))
+            pending_instance_ids.difference_update(ids)
+            mark_seen(ids)
+            done = True
+
+        if wait:
+            retry_at = loop.time() + wait
+            retry_delay = min(retry_delay * 2, NOTIFY_RETRY_MAX_SECONDS)
+        elif not retry:
+            retry_delay = NOTIFY_RETRY_MIN_SECONDS
+
+        if done:  # 保存するのは送信済み（または再送しない）IDだけ
+            try:
+                await save_seen_instance_ids()
+            except Exception as e:
+                logger.error("❌ 通知済みIDの保存に失敗: %s", e)
+
+def _is_retryable(error: Exception) -> bool:
+    # 429・5xx・通信エラーは時間をおけば通る可能性がある
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(error, httpx.HTTPError)
+
+def _retry_after(error: Exception) -> float:
+    # 429のRetry-Afterヘッダ（秒）があればそれ以上待つ
+    if isinstance(error, httpx.HTTPStatusError):
+        try:
+            return min(float(error.response.headers.get("retry-after", 0)), NOTIFY_RETRY_MAX_SECONDS)
+        except ValueError:
+            pass
+    return 0.0
+
+def mark_seen(ids: list[str]):
+    for instance_id in ids:
+        seen_instance_ids[instance_id] = None
+    while len(seen_instance_ids) > seen_limit:
+        seen_instance_ids.popitem(last=False)
+
+def enqueue_new_instances(instances) -> int:
+    new = 0
+    for instance in instances:
+        instance_id = instance["instanceId"]
+        if instance_id in seen_instance_ids:
+            seen_instance_ids.move_to_end(instance_id)  # まだ続いているので古い扱いにしない
+            continue
+        if instance_id in pending_instance_ids:
+            continue
+        pending_instance_ids.add(instance_id)
+        notify_queue.put_nowait(instance)
+        new += 1
+    return new
+
+# --------------------------------------------------------
+# 定期監視処理（60秒おき）
+# --------------------------------------------------------
+async def check_for_instances():
+    global seen_limit
+    if pipeline_connected:
+        return  # WebSocketでイベントを受信中
     try:
         instances = await get_group_instances()
         if not instances:
-            print("⚠ インスタンスなし")
+            logger.debug("⚠ インスタンスなし")
             return
 
-        latest = instances[0]
-        current_id = latest["instanceId"]
-
-        if current_id != last_instance_id:
-            await notify_discord(latest)
-            last_instance_id = current_id
-            print("✅ Discordに通知を送信しました")
-        else:
-            print("🔁 インスタンスに変化なし")
+        seen_limit = max(SEEN_INSTANCE_LIMIT, len(instances))
+        if enqueue_new_instances(instances) == 0:
+            logger.debug("🔁 インスタンスに変化なし")
     except Exception as e:
-        print("❌ チェック中にエラー発生:", e)
+        logger.error("❌ チェック中にエラー発生: %s", e)
+
+# --------------------------------------------------------
+# VRChat Pipeline（WebSocket）でインスタンス作成イベントを受信
+# 切断中は定期監視処理にフォールバック
+# --------------------------------------------------------
+def _auth_token(client: httpx.AsyncClient) -> str | None:
+    # Domain属性付きだと ".api.vrchat.cloud" で保存されるので、完全一致では探さない
+    for cookie in client.cookies.jar:
+        if cookie.name == "auth" and cookie.domain.lstrip(".").endswith("vrchat.cloud"):
+            return cookie.value
+    return None
+
+def _parse_pipeline_frame(frame) -> dict | None:
+    # group-instance-* のフレームからインスタンス情報を取り出す（それ以外・壊れたものはNone）
+    try:
+        msg = orjson.loads(frame)
+        if not isinstance(msg, dict) or not str(msg.get("type", "")).startswith("group-instance-"):
+            return None
+        content = msg.get("content", {})
+        if isinstance(content, str):  # contentはJSON文字列で届く
+            content = orjson.loads(content)
+    except orjson.JSONDecodeError as e:
+        logger.warning("⚠ Pipelineのフレームを解析できません: %s", e)
+        return None
+
+    instance = content.get("instance") if isinstance(content, dict) else None
+    if not isinstance(instance, dict) or not instance.get("instanceId"):
+        return None
+    return instance
+
+async def listen_pipeline():
+    global pipeline_connected, vrc_client
+    while True:
+        try:
+            client = await login_vrchat()
+            token = _auth_token(client)
+            if not token:
+                vrc_client = None
+                raise Exception("authTokenが取得できません")
+
+            async with websockets.connect(f"wss://pipeline.vrchat.cloud/?authToken={token}") as ws:
+                pipeline_connected = True
+                logger.info("🔌 Pipelineに接続しました")
+                async for frame in ws:
+                    instance = _parse_pipeline_frame(frame)
+                    if instance:
+                        enqueue_new_instances([instance])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("❌ Pipeline受信中にエラー発生: %s", e)
+        finally:
+            pipeline_connected = False
+
+        logger.warning("⚠ Pipeline切断、60秒後に再接続します（その間は定期監視）")
+        await asyncio.sleep(60)
+
+# --------------------------------------------------------
+# リーダー選出（ロックを取れたworkerだけが監視・通知を行う）
+# --------------------------------------------------------
+def acquire_leader_lock() -> int | None:
+    if fcntl is None:
+        return -1
+    fd = os.open(settings.LEADER_LOCK_PATH, os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd  # プロセス終了（またはclose）までロックを保持
+
+# --------------------------------------------------------
+# アプリのライフサイクル（共有クライアント・通知/Pipeline・スケジューラの生成・破棄）
+# --------------------------------------------------------
+def _log_task_exit(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        logger.error("❌ %s が停止しました", task.get_name(), exc_info=task.exception())
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global app_client, vrc_client
+    log_listener.start()
+    app_client = httpx.AsyncClient(
+        http2=True,
+        # 60秒おきの監視・通知の間も接続が切れないよう、keepaliveは周期より長くする
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=90),
+        timeout=httpx.Timeout(10.0),
+    )
+    load_seen_instance_ids()
+    sched = AsyncIOScheduler()
+    tasks: list[asyncio.Task] = []  # 停止時にcancelしてgatherする
+    leader_fd = acquire_leader_lock() if settings.SCHEDULER_ENABLED else None
+    if leader_fd is None:
+        if settings.SCHEDULER_ENABLED:
+            logger.info("ℹ 他のworkerが監視中のため、このworkerは監視しません")
+    else:
+        tasks.append(asyncio.create_task(notify_worker(), name="notify_worker"))
+        tasks.append(asyncio.create_task(listen_pipeline(), name="listen_pipeline"))
+        for task in tasks:
+            task.add_done_callback(_log_task_exit)
+        sched.add_job(
+            check_for_instances, "interval", seconds=60,
+            max_instances=1, coalesce=True, misfire_grace_time=30,
+            next_run_time=datetime.now(),  # 起動直後に1回目を実行
+        )
+        sched.start()
+    try:
+        yield
+    finally:
+        if sched.running:
+            sched.shutdown(wait=False)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if leader_fd is not None and leader_fd >= 0:
+            os.close(leader_fd)
+        vrc_client = None
+        await app_client.aclose()
+        log_listener.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 # --------------------------------------------------------
 # インスタンス確認API
@@ -178,5 +573,8 @@ async def test_notification():
             "thumbnailImageUrl": "https://upload.wikimedia.org/wikipedia/commons/thumb/e/ec/VR_icon.svg/1024px-VR_icon.svg.png"
         }
     }
-    await notify_discord(fake_instance)
+    try:
+        await notify_discord([fake_instance], dedup=False)  # 手動テストは毎回送る
+    except Exception as e:
+        return {"error": str(e)}
     return {"message": "テストメッセージを送信しました"}